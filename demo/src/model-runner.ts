@@ -13,18 +13,24 @@ ort.env.wasm.wasmPaths =
 
 let cachedModels: Models | null = null;
 
+/** Create a session for one hand, preferring the INT8 model over FP32. */
+async function createSession(modelsBase: string, hand: "left" | "right") {
+  const base = `${modelsBase}fingering_transformer_${hand}`;
+  try {
+    return await ort.InferenceSession.create(`${base}.int8.onnx`);
+  } catch {
+    return ort.InferenceSession.create(`${base}.onnx`);
+  }
+}
+
 async function getModels(): Promise<Models> {
   if (cachedModels) return cachedModels;
 
   const modelsBase = `${import.meta.env.BASE_URL}models/`;
 
   // Load sequentially — WASM backend doesn't support concurrent session creation
-  const left = await ort.InferenceSession.create(
-    `${modelsBase}fingering_transformer_left.onnx`
-  );
-  const right = await ort.InferenceSession.create(
-    `${modelsBase}fingering_transformer_right.onnx`
-  );
+  const left = await createSession(modelsBase, "left");
+  const right = await createSession(modelsBase, "right");
 
   cachedModels = {
     left: left as unknown as Models["left"],
@@ -12,7 +12,8 @@ let cachedModels: Models | null = null;
  * Node.js only — requires `fs` and `path`. For browser usage, create
  * InferenceSession objects manually and pass them to `predictFingerings()`.
  *
- * Sessions are cached after the first call.
+ * The INT8 quantized models are used when present, with the FP32 models
+ * as fallback. Sessions are cached after the first call.
  */
 export async function loadModels(): Promise<Models> {
   if (cachedModels) return cachedModels;
@@ -22,9 +23,18 @@ export async function loadModels(): Promise<Models> {
 
   const modelsDir = path.resolve(__dirname, "..", "models");
 
+  const readModel = async (hand: "left" | "right") => {
+    const base = path.join(modelsDir, `fingering_transformer_${hand}`);
+    try {
+      return await fs.readFile(`${base}.int8.onnx`);
+    } catch {
+      return fs.readFile(`${base}.onnx`);
+    }
+  };
+
   const [leftBuf, rightBuf] = await Promise.all([
-    fs.readFile(path.join(modelsDir, "fingering_transformer_left.onnx")),
-    fs.readFile(path.join(modelsDir, "fingering_transformer_right.onnx")),
+    readModel("left"),
+    readModel("right"),
   ]);
 
   const [left, right] = await Promise.all([
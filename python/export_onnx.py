@@ -1,16 +1,64 @@
 """Export trained PyTorch checkpoints to ONNX format.
 
-Outputs .onnx files to js/models/ for inclusion in the npm package.
+Outputs .onnx files to js/models/ for inclusion in the npm package: the FP32
+model, plus an INT8 dynamically quantized model when it agrees with FP32 on
+the PIG and scale datasets (loaders prefer it when present).
 """
 
+import tempfile
 from pathlib import Path
+import numpy as np
+import onnxruntime as ort
 import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from onnxruntime.transformers.optimizer import optimize_model
 from model import FingeringTransformer
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 CHECKPOINTS_DIR = PROJECT_ROOT / "checkpoints"
+DATA_DIR = PROJECT_ROOT / "data"
 JS_MODELS_DIR = PROJECT_ROOT / "js" / "models"
 
+MIN_INT8_AGREEMENT = 0.99
+N_AGREEMENT_SAMPLES = 4096
+
+
+def agreement_tokens(hand: str, seed=42) -> np.ndarray:
+    """Up to N_AGREEMENT_SAMPLES token rows from the PIG and scale datasets.
+
+    Only files already in the model's (N, 26, 5) token layout are used; finger
+    hints are hidden, as at inference time for unfingered notes.
+    """
+    sources = []
+    for name in [f"pig_fingering_data_{hand}.npz", f"scale_fingering_data_{hand}.npz"]:
+        try:
+            X = np.load(DATA_DIR / name)['X']
+        except FileNotFoundError:
+            continue
+        if X.ndim == 3 and X.shape[1:] == (26, 5):
+            sources.append(X)
+    if not sources:
+        raise FileNotFoundError(f"No (N, 26, 5) PIG or scale data for {hand} hand in {DATA_DIR}")
+
+    X = np.concatenate(sources, axis=0)
+    rng = np.random.default_rng(seed)
+    indices = rng.permutation(len(X))[:N_AGREEMENT_SAMPLES]
+    tokens = X[indices].astype(np.float32)
+    tokens[:, 6:26, 4] = -1.0
+    return tokens
+
+
+def quantized_agreement(fp32_path: Path, int8_path: Path, hand: str) -> float:
+    """Fraction of PIG / scale rows on which FP32 and INT8 pick the same finger."""
+    tokens = agreement_tokens(hand)
+
+    fp32 = ort.InferenceSession(str(fp32_path), providers=["CPUExecutionProvider"])
+    int8 = ort.InferenceSession(str(int8_path), providers=["CPUExecutionProvider"])
+    fp32_preds = fp32.run(["logits"], {"tokens": tokens})[0].argmax(axis=1)
+    int8_preds = int8.run(["logits"], {"tokens": tokens})[0].argmax(axis=1)
+
+    return float((fp32_preds == int8_preds).mean())
+
 
 def export_model(hand: str):
     """Export a trained model to ONNX format."""
@@ -18,33 +66,60 @@ def export_model(hand: str):
     JS_MODELS_DIR.mkdir(parents=True, exist_ok=True)
     onnx_path = JS_MODELS_DIR / f"fingering_transformer_{hand}.onnx"
 
-    checkpoint = torch.load(pt_path, map_location="cpu", weights_only=True)
-
-    model = FingeringTransformer(
-        d_model=checkpoint["d_model"],
-        nhead=checkpoint["nhead"],
-        num_layers=checkpoint["num_layers"],
-        dim_feedforward=checkpoint.get("dim_feedforward", 128),
-    )
-    model.load_state_dict(checkpoint["model_state"])
-    model.eval()
+    model = FingeringTransformer.from_checkpoint(pt_path).fuse_for_inference()
 
     dummy_input = torch.randn(1, 26, 5)
+    int8_path = onnx_path.with_suffix(".int8.onnx")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Plain export (standard ONNX ops only), kept as the quantization input
+        raw_path = Path(tmp_dir) / onnx_path.name
+        torch.onnx.export(
+            model,
+            dummy_input,
+            str(raw_path),
+            input_names=["tokens"],
+            output_names=["logits"],
+            dynamic_axes={
+                "tokens": {0: "batch"},
+                "logits": {0: "batch"},
+            },
+            opset_version=17,
+            do_constant_folding=True,
+        )
+
+        # Shipped FP32 model: ORT's basic graph optimizations, including constant
+        # folding, plus whichever bert fusions match the graph (these can add
+        # com.microsoft ops such as SkipLayerNormalization); report what fused
+        optimized = optimize_model(
+            str(raw_path),
+            model_type="bert",
+            num_heads=model.nhead,
+            hidden_size=model.d_model,
+            opt_level=1,
+        )
+        optimized.save_model_to_file(str(onnx_path))
+
+        fused = {op: n for op, n in optimized.get_fused_operator_statistics().items() if n}
+        print(f"Exported: {onnx_path} (fused ops: {fused or 'none'})")
+
+        # INT8 weights for MatMul / Gemm nodes (Linear layers and attention
+        # projections). Quantizes the unfused graph: quantize_dynamic can't infer
+        # tensor types through the contrib ops the fusions introduce
+        quantize_dynamic(
+            str(raw_path),
+            str(int8_path),
+            weight_type=QuantType.QInt8,
+            op_types_to_quantize=["MatMul", "Gemm"],
+        )
 
-    torch.onnx.export(
-        model,
-        dummy_input,
-        str(onnx_path),
-        input_names=["tokens"],
-        output_names=["logits"],
-        dynamic_axes={
-            "tokens": {0: "batch"},
-            "logits": {0: "batch"},
-        },
-        opset_version=17,
-    )
-
-    print(f"Exported: {onnx_path}")
+    agreement = quantized_agreement(onnx_path, int8_path, hand)
+    if agreement < MIN_INT8_AGREEMENT:
+        # Drop it so loaders fall back to the FP32 model
+        int8_path.unlink()
+        print(f"  INT8 agreement {agreement:.2%} < {MIN_INT8_AGREEMENT:.0%}, not shipping {int8_path.name}")
+    else:
+        print(f"Exported: {int8_path} (agreement {agreement:.2%})")
 
 
 if __name__ == "__main__":
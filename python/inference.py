@@ -14,76 +14,139 @@ Output: Same format with predicted finger values.
 """
 
 import argparse
+import hashlib
 import json
+import os
+import tempfile
 from pathlib import Path
 import numpy as np
-import torch
 
-from model import FingeringTransformer
+# torch (and model.py, which imports it) are imported inside the functions that
+# need them, so `--help` and argument errors don't pay the torch import cost
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 
 BLACK_KEY_NOTES = [1, 4, 6, 9, 11]  # A#, C#, D#, F#, G# (key_index % 12)
 
+# Lookup tables indexed by MIDI number (0-127)
+_KEY_INDEX = (np.arange(128) - 21) % 12
+_BLACK_LUT = np.isin(_KEY_INDEX, BLACK_KEY_NOTES).astype(np.float32)
+_PITCH_LUT = (_KEY_INDEX / 11.0).astype(np.float32)
+
+# All features unused (-1); copied into the token buffer before each note
+_TOKEN_TEMPLATE = np.full((26, 5), -1.0, dtype=np.float32)
+
 
 def is_black_key(midi: int) -> float:
     """Return 1.0 if black key, 0.0 if white key, -1.0 if invalid."""
-    if midi < 0:
-        return -1.0
-    key_index = midi - 21
-    return 1.0 if (key_index % 12) in BLACK_KEY_NOTES else 0.0
+    return float(_BLACK_LUT[midi]) if 0 <= midi < 128 else -1.0
 
 
 def midi_to_pitch_class(midi: int) -> float:
     """Convert MIDI to pitch class (0-11) normalized to 0-1."""
-    if midi < 0:
-        return -1.0
-    pitch_class = (midi - 21) % 12
-    return pitch_class / 11.0
+    return float(_PITCH_LUT[midi]) if 0 <= midi < 128 else -1.0
 
 
-def load_model(hand: str):
-    """Load trained fingering transformer."""
-    model_path = PROJECT_ROOT / "checkpoints" / f"fingering_transformer_{hand}.pt"
-    checkpoint = torch.load(model_path, map_location='cpu', weights_only=True)
+def _script_cache_key(model_path: Path, torch_version: str) -> str:
+    """Hash of everything the traced graph depends on: weights, model code, torch."""
+    digest = hashlib.sha256()
+    digest.update(model_path.read_bytes())
+    digest.update((Path(__file__).resolve().parent / "model.py").read_bytes())
+    digest.update(torch_version.encode())
+    return digest.hexdigest()
 
-    model = FingeringTransformer(
-        d_model=checkpoint['d_model'],
-        nhead=checkpoint['nhead'],
-        num_layers=checkpoint['num_layers'],
-        dim_feedforward=checkpoint.get('dim_feedforward', 128)
-    )
-    model.load_state_dict(checkpoint['model_state'])
-    model.eval()
-    return model
 
+def load_model(hand: str, compile: bool = False):
+    """Load trained fingering transformer.
 
-def build_tokens(current_midi: int, finger_last_midi: list, finger_last_time: list,
-                 lookahead_notes: list) -> np.ndarray:
-    """Build 26x5 input tokens for a single note prediction."""
-    tokens = np.zeros((26, 5), dtype=np.float32)
-    tokens[:, 4] = -1.0  # Default: finger_hint unused/unknown
+    By default returns a TorchScript module traced from the checkpoint. The
+    traced module is cached next to the checkpoint as .ts, keyed on the
+    checkpoint, model.py and the torch version; it is re-traced when any of
+    them change. If the cache can't be written, the traced module is still
+    returned.
+
+    With compile=True the eager model is wrapped in torch.compile instead and
+    warmed up once, which pays a one-off compilation cost for faster per-note calls.
+    """
+    import torch
+    from model import FingeringTransformer
+
+    model_path = PROJECT_ROOT / "checkpoints" / f"fingering_transformer_{hand}.pt"
+    script_path = model_path.with_suffix('.ts')
+
+    if not compile:
+        cache_key = _script_cache_key(model_path, torch.__version__)
+        if script_path.exists():
+            extra_files = {'cache_key': ''}
+            try:
+                cached = torch.jit.load(script_path, map_location='cpu', _extra_files=extra_files)
+            except RuntimeError:
+                cached = None  # Unreadable cache: re-trace below
+            if cached is not None and extra_files['cache_key'] == cache_key.encode():
+                return cached
+
+    model = FingeringTransformer.from_checkpoint(model_path).fuse_for_inference()
+
+    if compile:
+        # Input shape is fixed at (1, 26, 5), so compile a single static graph
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        with torch.inference_mode():
+            model(torch.zeros(1, 26, 5))
+        return model
+
+    # Fixed (1, 26, 5) input and no data-dependent control flow: safe to trace
+    traced = torch.jit.trace(model, torch.randn(1, 26, 5))
+    traced = torch.jit.optimize_for_inference(traced)
+
+    # Write to a temp file and rename, so readers never see a partial cache
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=script_path.parent, suffix='.ts.tmp')
+        os.close(fd)
+        try:
+            traced.save(tmp_name, _extra_files={'cache_key': cache_key})
+            os.replace(tmp_name, script_path)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+    except OSError:
+        pass  # Read-only checkpoints dir: run uncached
+
+    return traced
+
+
+def black_key_mask(midi: np.ndarray) -> np.ndarray:
+    """Vectorized is_black_key: 1.0 black, 0.0 white, -1.0 invalid (outside 0-127)."""
+    black = _BLACK_LUT[np.clip(midi, 0, 127).astype(np.intp)]
+    return np.where((midi >= 0) & (midi < 128), black, -1.0)
+
+
+def build_tokens(current_midi: int, finger_last_midi: np.ndarray, finger_last_time: np.ndarray,
+                 lookahead_midi: np.ndarray, lookahead_time_until: np.ndarray,
+                 lookahead_finger: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Build 26x5 input tokens for a single note prediction.
+
+    finger_last_midi / finger_last_time: (5,) per-finger state (-1 / inf = never used).
+    lookahead_*: up to 20 upcoming notes; lookahead_finger is 0-4, or -1 if unknown.
+    If `out` is given, the tokens are written into it instead of a new array.
+    """
+    if out is None:
+        tokens = _TOKEN_TEMPLATE.copy()
+    else:
+        tokens = out
+        np.copyto(tokens, _TOKEN_TEMPLATE)  # Default: everything unused (-1)
 
     # Reference: current note
     ref_midi_norm = (current_midi - 21) / 87.0
 
     # Previous tokens (5): one per finger
-    for f in range(5):
-        midi = finger_last_midi[f]
-        if midi >= 0:
-            midi_norm = (midi - 21) / 87.0
-            tokens[f, 0] = midi_norm - ref_midi_norm  # offset from current
-        else:
-            tokens[f, 0] = -1.0  # never used
-
-        # Time since release (negative = still holding)
-        if finger_last_time[f] == float('inf'):
-            tokens[f, 1] = 1.0  # never used
-        else:
-            tokens[f, 1] = max(0.0, min(finger_last_time[f], 10.0)) / 10.0
-
-        tokens[f, 2] = is_black_key(int(midi)) if midi >= 0 else -1.0
-        tokens[f, 3] = 0.0  # token_type = previous
+    prev = tokens[0:5]
+    used = finger_last_midi >= 0
+    prev[:, 0] = np.where(used, (finger_last_midi - 21) / 87.0 - ref_midi_norm, -1.0)
+    # Time since release (negative = still holding), 1.0 = never used
+    prev[:, 1] = np.where(finger_last_time == np.inf, 1.0,
+                          np.clip(finger_last_time, 0.0, 10.0) / 10.0)
+    prev[:, 2] = black_key_mask(finger_last_midi)
+    prev[:, 3] = 0.0  # token_type = previous
 
     # Current token (1)
     tokens[5, 0] = midi_to_pitch_class(current_midi)
@@ -91,33 +154,17 @@ def build_tokens(current_midi: int, finger_last_midi: list, finger_last_time: li
     tokens[5, 2] = is_black_key(current_midi)
     tokens[5, 3] = 0.5  # token_type = current
 
-    # Lookahead tokens (20)
-    for j in range(20):
-        if j < len(lookahead_notes):
-            ln = lookahead_notes[j]
-            midi = ln['midi']
-            if midi >= 0:
-                midi_norm = (midi - 21) / 87.0
-                tokens[6 + j, 0] = midi_norm - ref_midi_norm
-            else:
-                tokens[6 + j, 0] = -1.0
-
-            time_until = ln['time_until']
-            if time_until < 0:
-                tokens[6 + j, 1] = -1.0
-            else:
-                tokens[6 + j, 1] = min(time_until / 1000.0, 10.0) / 10.0
-
-            tokens[6 + j, 2] = is_black_key(midi) if midi >= 0 else -1.0
-            tokens[6 + j, 3] = 1.0  # token_type = lookahead
-
-            # Finger hint: if the note has a fixed finger, include it
-            if 'finger' in ln and ln['finger'] is not None and 0 <= ln['finger'] <= 4:
-                tokens[6 + j, 4] = ln['finger'] / 4.0
-            else:
-                tokens[6 + j, 4] = -1.0
-        else:
-            tokens[6 + j, :] = -1.0
+    # Lookahead tokens (20); rows past the end of the piece stay -1
+    look = tokens[6:6 + len(lookahead_midi)]
+    look[:, 0] = np.where(lookahead_midi >= 0, (lookahead_midi - 21) / 87.0 - ref_midi_norm, -1.0)
+    look[:, 1] = np.where(lookahead_time_until < 0, -1.0,
+                          np.minimum(lookahead_time_until / 1000.0, 10.0) / 10.0)
+    look[:, 2] = black_key_mask(lookahead_midi)
+    look[:, 3] = 1.0  # token_type = lookahead
+
+    # Finger hint: if the note has a fixed finger, include it
+    hinted = (lookahead_finger >= 0) & (lookahead_finger <= 4)
+    look[:, 4] = np.where(hinted, lookahead_finger / 4.0, -1.0)
 
     return tokens
 
@@ -128,75 +175,85 @@ def predict_fingerings(notes: list[dict], hand: str, model, is_left: bool) -> li
     Notes with finger=1-5 are treated as fixed; notes without finger are predicted.
     Fixed fingers in lookahead are passed to the model as hints.
     """
-    hand_notes = [n for n in notes if n['left'] == is_left]
+    import torch
+
+    is_hand = np.fromiter((n['left'] == is_left for n in notes), dtype=bool, count=len(notes))
+    hand_notes = [notes[k] for k in np.flatnonzero(is_hand)]
 
     if not hand_notes:
         return []
 
+    # Parallel per-note arrays
+    times = np.array([n['time'] for n in hand_notes], dtype=np.float64)
+    midis = np.array([n['note'] for n in hand_notes], dtype=np.int64)
+    durations = np.array([n.get('duration') or 100 for n in hand_notes], dtype=np.float64)
+    # Fixed finger 1-5, or 0 if the note is to be predicted
+    fixed = np.array([f if (f := n.get('finger')) is not None and 1 <= f <= 5 else 0
+                      for n in hand_notes], dtype=np.int64)
+
     # Sort by (time, midi) - this naturally orders chord notes lowest-to-highest
-    sorted_notes = sorted(hand_notes, key=lambda n: (n['time'], n['note']))
+    order = np.lexsort((midis, times))
+    times, midis, durations, fixed = times[order], midis[order], durations[order], fixed[order]
+    fingers = fixed.copy()  # Predictions are filled in below
+    n_notes = len(order)
+
+    # Lookahead for every note at once: row i holds notes i+1..i+20 (time until
+    # is 0 for same-chord notes, finger hint 0-4 for fixed notes, else -1)
+    lookahead_midi = np.full((n_notes, 20), -1, dtype=np.int64)
+    lookahead_time_until = np.full((n_notes, 20), -1.0)
+    lookahead_finger = np.full((n_notes, 20), -1, dtype=np.int64)
+    for k in range(1, min(20, n_notes - 1) + 1):
+        lookahead_midi[:-k, k - 1] = midis[k:]
+        lookahead_time_until[:-k, k - 1] = times[k:] - times[:-k]
+        lookahead_finger[:-k, k - 1] = fixed[k:] - 1
+    n_lookahead = np.minimum(20, n_notes - 1 - np.arange(n_notes))
 
     # Track per-finger state
-    finger_last_midi = [-1.0] * 5
-    finger_last_time = [float('inf')] * 5
-
+    finger_last_midi = np.full(5, -1.0)
+    finger_last_time = np.full(5, np.inf)
+
+    # Token buffer reused for every note; the input tensor shares its memory,
+    # so writing the tokens is all that is needed to update the model input
+    tokens = np.empty((1, 26, 5), dtype=np.float32)
+    input_tensor = torch.from_numpy(tokens)
+
+    # Each prediction feeds the finger state of the next note (including the
+    # next note of the same chord), so notes are run one at a time. Notes with
+    # a fixed finger skip the forward pass entirely.
+    with torch.inference_mode():
+        for i in range(n_notes):
+            current_time = times[i]
+            current_midi = int(midis[i])
+
+            if not fixed[i]:
+                # Build tokens and predict
+                n = n_lookahead[i]
+                build_tokens(current_midi, finger_last_midi, finger_last_time,
+                             lookahead_midi[i, :n], lookahead_time_until[i, :n],
+                             lookahead_finger[i, :n], out=tokens[0])
+                logits = model(input_tensor)[0]  # (5,)
+                pred = logits.argmax().item()
+
+                fingers[i] = pred + 1  # Convert 0-4 to 1-5
+
+            # Update finger state
+            finger_idx = fingers[i] - 1
+            finger_last_midi[finger_idx] = current_midi
+            finger_last_time[finger_idx] = -durations[i] / 1000.0  # negative = still holding
+
+            # Age finger times for next note (never-used fingers stay at inf)
+            if i + 1 < n_notes:
+                dt = (times[i + 1] - current_time) / 1000.0
+                finger_last_time += dt
+
+    # Fixed fingerings are kept as given; predicted ones are filled in
     results = []
-
-    for i, note in enumerate(sorted_notes):
-        current_time = note['time']
-        current_midi = note['note']
-
-        # Build lookahead from next 20 notes
-        lookahead = []
-        for future_note in sorted_notes[i + 1:i + 21]:
-            time_until = future_note['time'] - current_time  # 0 for same-chord notes
-
-            # Include finger hint if the note has a fixed finger (1-5 -> 0-4)
-            future_finger = future_note.get('finger')
-            if future_finger is not None and 1 <= future_finger <= 5:
-                finger_hint = future_finger - 1  # Convert 1-5 to 0-4
-            else:
-                finger_hint = None
-
-            lookahead.append({
-                'midi': future_note['note'],
-                'time_until': time_until,
-                'finger': finger_hint
-            })
-
-        # Build tokens and predict
-        tokens = build_tokens(current_midi, finger_last_midi, finger_last_time, lookahead)
-
-        with torch.no_grad():
-            input_tensor = torch.tensor(tokens, dtype=torch.float32).unsqueeze(0)
-            logits = model(input_tensor)[0]  # (5,)
-            pred = logits.argmax().item()
-
-        result_note = note.copy()
-
-        # If note has fixed fingering (1-5), keep it; otherwise use prediction
-        existing_finger = note.get('finger')
-        if existing_finger is not None and 1 <= existing_finger <= 5:
-            finger = existing_finger
-        else:
-            finger = pred + 1  # Convert 0-4 to 1-5
+    for k, fixed_finger, finger in zip(order.tolist(), fixed.tolist(), fingers.tolist()):
+        result_note = hand_notes[k].copy()
+        if not fixed_finger:
             result_note['finger'] = finger
-
         results.append(result_note)
 
-        # Update finger state
-        finger_idx = finger - 1
-        finger_last_midi[finger_idx] = current_midi
-        duration_sec = (note.get('duration') or 100) / 1000.0
-        finger_last_time[finger_idx] = -duration_sec  # negative = still holding
-
-        # Age finger times for next note
-        if i + 1 < len(sorted_notes):
-            dt = (sorted_notes[i + 1]['time'] - current_time) / 1000.0
-            for f in range(5):
-                if finger_last_time[f] != float('inf'):
-                    finger_last_time[f] += dt
-
     return results
 
 
@@ -204,7 +261,20 @@ def main():
     parser = argparse.ArgumentParser(description='Predict fingerings for notes')
     parser.add_argument('input', help='Input JSON file')
     parser.add_argument('-o', '--output', help='Output JSON file (default: input_fingered.json)')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile models with torch.compile (slower startup, faster per note)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='PyTorch intra-op threads (default: 1; the model is too small to gain from more)')
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error(f"--threads must be at least 1, got {args.threads}")
+
+    # Thread pools are sized when torch is first imported, so set these before
+    os.environ['OMP_NUM_THREADS'] = str(args.threads)
+    os.environ['MKL_NUM_THREADS'] = str(args.threads)
+    import torch
+    torch.set_num_threads(args.threads)
+    torch.set_num_interop_threads(1)
 
     # Load input
     with open(args.input) as f:
@@ -213,8 +283,8 @@ def main():
     print(f"Loaded {len(notes)} notes")
 
     # Load models
-    left_model = load_model('left')
-    right_model = load_model('right')
+    left_model = load_model('left', compile=args.compile)
+    right_model = load_model('right', compile=args.compile)
     print("Loaded models")
 
     # Predict for each hand
@@ -14,6 +14,7 @@ Output: single finger prediction (0-4)
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class PositionalEncoding(nn.Module):
@@ -30,6 +31,104 @@ class PositionalEncoding(nn.Module):
         return x + self.pe[:, :x.size(1)]
 
 
+class SelfAttention(nn.Module):
+    """Multi-head attention on F.scaled_dot_product_attention.
+
+    Parameter names match nn.MultiheadAttention, so existing checkpoints load.
+    """
+
+    def __init__(self, d_model, nhead, dropout=0.0):
+        super().__init__()
+        self.nhead = nhead
+        self.dropout = dropout
+
+        # Fused q/k/v projection
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * d_model, d_model))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * d_model))
+        self.out_proj = nn.Linear(d_model, d_model)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x, index=None):
+        """
+        x: (batch, seq, d_model)
+        index: if given, only token `index` is used as a query (q_len = 1);
+               it still attends to every token. Defaults to full self-attention.
+        Returns: (batch, q_len, d_model)
+        """
+        # Always one packed q/k/v projection, so the weight is a single matrix
+        # in both paths (and a single initializer in the ONNX export)
+        d_model = x.size(-1)
+        q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        if index is not None:
+            q = q[:, index:index + 1]
+
+        # (batch, len, d_model) -> (batch, nhead, len, head_dim)
+        batch, q_len = q.shape[:2]
+        head_dim = d_model // self.nhead
+        q = q.reshape(batch, q_len, self.nhead, head_dim).transpose(1, 2)
+        k = k.reshape(batch, -1, self.nhead, head_dim).transpose(1, 2)
+        v = v.reshape(batch, -1, self.nhead, head_dim).transpose(1, 2)
+
+        out = F.scaled_dot_product_attention(
+            q, k, v, dropout_p=self.dropout if self.training else 0.0)
+        out = out.transpose(1, 2).reshape(batch, q_len, d_model)
+
+        return self.out_proj(out)
+
+
+class EncoderLayer(nn.Module):
+    """Post-norm Transformer encoder layer (ReLU FFN) using SelfAttention.
+
+    Same structure and parameter names as nn.TransformerEncoderLayer.
+    """
+
+    def __init__(self, d_model, nhead, dim_feedforward, dropout):
+        super().__init__()
+        self.self_attn = SelfAttention(d_model, nhead, dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+    def forward(self, x, index=None):
+        """
+        x: (batch, seq, d_model)
+        index: if given, only token `index` is computed (q_len = 1); defaults to all of x
+        Returns: (batch, q_len, d_model)
+        """
+        src = x if index is None else x[:, index:index + 1]
+        src = self.norm1(src + self.dropout1(self.self_attn(x, index)))
+        ff = self.linear2(self.dropout(F.relu(self.linear1(src))))
+        return self.norm2(src + self.dropout2(ff))
+
+
+class Encoder(nn.Module):
+    """Stack of EncoderLayers (keeps the transformer.layers.N checkpoint keys)."""
+
+    def __init__(self, d_model, nhead, num_layers, dim_feedforward, dropout):
+        super().__init__()
+        self.layers = nn.ModuleList([
+            EncoderLayer(d_model, nhead, dim_feedforward, dropout) for _ in range(num_layers)
+        ])
+
+    def forward(self, x, index):
+        """
+        x: (batch, seq, d_model)
+        Returns: (batch, d_model) - output for token `index` only
+        """
+        for layer in self.layers[:-1]:
+            x = layer(x)
+
+        # Only one token is needed from the last layer, so only it is computed
+        # (still attending to every token)
+        return self.layers[-1](x, index)[:, 0]
+
+
 class FingeringTransformer(nn.Module):
     def __init__(self, d_model=64, nhead=4, num_layers=3, dim_feedforward=128, dropout=0.1):
         super().__init__()
@@ -39,19 +138,47 @@ class FingeringTransformer(nn.Module):
 
         self.pos_encoder = PositionalEncoding(d_model)
 
-        encoder_layer = nn.TransformerEncoderLayer(
+        # Set by fuse_for_inference(): positional encoding pre-sliced to (1, 26, d_model)
+        self.register_buffer('pos_bias', None, persistent=False)
+
+        self.transformer = Encoder(
             d_model=d_model,
             nhead=nhead,
+            num_layers=num_layers,
             dim_feedforward=dim_feedforward,
-            dropout=dropout,
-            batch_first=True
+            dropout=dropout
         )
-        self.transformer = nn.TransformerEncoder(encoder_layer, num_layers=num_layers)
 
         # Output: single finger prediction (5 classes)
         self.output_head = nn.Linear(d_model, 5)
 
         self.d_model = d_model
+        self.nhead = nhead
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        """Load a model saved by train.py, in eval mode on CPU."""
+        checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+
+        model = cls(
+            d_model=checkpoint['d_model'],
+            nhead=checkpoint['nhead'],
+            num_layers=checkpoint['num_layers'],
+            dim_feedforward=checkpoint.get('dim_feedforward', 128)
+        )
+        model.load_state_dict(checkpoint['model_state'])
+        model.eval()
+        return model
+
+    def fuse_for_inference(self):
+        """Replace the positional encoder with a constant (1, 26, d_model) bias.
+
+        Inference only: the fused model no longer has pos_encoder, so its
+        state_dict does not match training checkpoints. Returns self.
+        """
+        self.pos_bias = self.pos_encoder.pe[:, :26].clone()
+        del self.pos_encoder
+        return self
 
     def forward(self, tokens):
         """
@@ -59,11 +186,13 @@ class FingeringTransformer(nn.Module):
         Returns: (batch, 5) - 5 finger logits
         """
         x = self.input_proj(tokens)  # (batch, 26, d_model)
-        x = self.pos_encoder(x)
-        x = self.transformer(x)  # (batch, 26, d_model)
+        if self.pos_bias is not None:
+            x = x + self.pos_bias
+        else:
+            x = self.pos_encoder(x)
 
         # Use the current note token (index 5) for prediction
-        current_token = x[:, 5, :]  # (batch, d_model)
+        current_token = self.transformer(x, 5)  # (batch, d_model)
 
         logits = self.output_head(current_token)  # (batch, 5)
 
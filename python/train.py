@@ -17,8 +17,10 @@ import argparse
 from pathlib import Path
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, TensorDataset
+import torch.nn.utils.parametrize as parametrize
+from torch.utils.data import DataLoader, TensorDataset, default_collate
 
 from model import FingeringTransformer
 
@@ -31,6 +33,9 @@ def mask_finger_hints(X_batch: torch.Tensor) -> torch.Tensor:
     For each sample, picks a random reveal_rate (0-1), then masks each
     lookahead finger hint with probability (1 - reveal_rate).
 
+    Masks in place - X_batch must be a tensor the caller owns (e.g. a fresh
+    DataLoader batch), not a view into the dataset.
+
     Args:
         X_batch: (batch, 26, 5) input tokens
 
@@ -38,25 +43,100 @@ def mask_finger_hints(X_batch: torch.Tensor) -> torch.Tensor:
         X_batch with some finger hints (feature 4, tokens 6-25) masked to -1
     """
     batch_size = X_batch.shape[0]
-    X_masked = X_batch.clone()
-
-    # Random reveal rate per sample
-    reveal_rates = torch.rand(batch_size, 1)  # (batch, 1)
 
-    # Random mask for each lookahead token (indices 6-25 = 20 tokens)
-    mask_probs = torch.rand(batch_size, 20)  # (batch, 20)
+    # One RNG call per batch: a reveal rate per sample, plus a mask draw for
+    # each lookahead token (indices 6-25 = 20 tokens)
+    draws = torch.rand(batch_size, 21)
+    reveal_rates = draws[:, :1]  # (batch, 1)
+    mask_probs = draws[:, 1:]  # (batch, 20)
 
     # Mask where random > reveal_rate (i.e., don't reveal)
     should_mask = mask_probs > reveal_rates  # (batch, 20)
 
     # Apply mask to feature 4 of lookahead tokens (indices 6-25)
-    X_masked[:, 6:26, 4] = torch.where(
-        should_mask,
-        torch.tensor(-1.0),
-        X_masked[:, 6:26, 4]
-    )
+    X_batch[:, 6:26, 4].masked_fill_(should_mask, -1.0)
+
+    return X_batch
+
+
+def collate_masked(batch):
+    """DataLoader collate_fn: stack samples, then mask finger hints.
+
+    Runs inside the DataLoader workers so augmentation overlaps with training.
+    """
+    X_batch, Y_batch = default_collate(batch)
+    return mask_finger_hints(X_batch), Y_batch
+
+
+class Int8WeightFakeQuant(nn.Module):
+    """Parametrization: symmetric per-tensor INT8 fake quantization of a weight.
+
+    Matches the QInt8 weight quantization export_onnx.py applies; gradients
+    pass straight through the rounding.
+    """
+
+    def forward(self, weight):
+        scale = max(weight.detach().abs().max().item(), 1e-8) / 127.0
+        return torch.fake_quantize_per_tensor_affine(weight, scale, 0, -127, 127)
+
+
+def make_optimizer(model, lr):
+    """AdamW, using the fused implementation where available."""
+    try:
+        return torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.01, fused=True)
+    except RuntimeError:
+        # Fused kernel not available for this device / PyTorch version
+        return torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.01)
+
+
+def finetune_qat(model, train_loader, X_val_masked, Y_val, epochs, lr):
+    """Quantization-aware finetune for INT8 deployment.
+
+    Fake-quantizes every matrix weight (Linear layers and attention projections)
+    while training, keeps the epoch with the best validation accuracy, then bakes
+    the INT8-representable values into the float weights.
+
+    Returns validation accuracy of the quantized weights.
+    """
+    quantized = [(module, name)
+                 for module in model.modules()
+                 for name, param in module.named_parameters(recurse=False)
+                 if param.dim() == 2]
+    for module, name in quantized:
+        parametrize.register_parametrization(module, name, Int8WeightFakeQuant())
 
-    return X_masked
+    optimizer = make_optimizer(model, lr)
+
+    best_val_acc = 0.0
+    best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+    for epoch in range(epochs):
+        model.train()
+        for X_batch, Y_batch in train_loader:
+            optimizer.zero_grad(set_to_none=True)
+            loss = F.cross_entropy(model(X_batch), Y_batch, label_smoothing=0.1)
+            loss.backward()
+            optimizer.step()
+
+        model.eval()
+        preds = predict_in_batches(model, X_val_masked)
+        val_acc = (preds == Y_val).float().mean().item()
+        if val_acc > best_val_acc + 1e-6:
+            best_val_acc = val_acc
+            best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+        print(f"  QAT epoch {epoch+1:3d}: val_acc={val_acc:.4f}, best={best_val_acc:.4f}")
+
+    model.load_state_dict(best_state)
+    for module, name in quantized:
+        parametrize.remove_parametrizations(module, name, leave_parametrized=True)
+
+    return best_val_acc
+
+
+def predict_in_batches(model, X: torch.Tensor, batch_size=1024) -> torch.Tensor:
+    """Argmax finger predictions for X, run in chunks to cap activation memory."""
+    with torch.inference_mode():
+        return torch.cat([model(X_chunk).argmax(dim=1) for X_chunk in X.split(batch_size)])
 
 
 def load_data(hand='right', val_split=0.2, seed=42):
@@ -105,8 +185,13 @@ def load_data(hand='right', val_split=0.2, seed=42):
 
 
 def train(hand='right', max_epochs=300, lr=0.001, d_model=64, nhead=4, num_layers=3,
-          dim_feedforward=128, patience=50, lr_patience=15, lr_factor=0.5, min_lr=1e-6):
-    """Train transformer fingering model."""
+          dim_feedforward=128, patience=50, lr_patience=15, lr_factor=0.5, min_lr=1e-6,
+          compile=False, num_workers=4, qat_epochs=0):
+    """Train transformer fingering model.
+
+    With compile=True, validation runs through a torch.compile'd view of the model.
+    With qat_epochs > 0, training ends with an INT8 quantization-aware finetune.
+    """
     print(f"Training {hand} hand fingering transformer...")
 
     data = load_data(hand)
@@ -115,15 +200,26 @@ def train(hand='right', max_epochs=300, lr=0.001, d_model=64, nhead=4, num_layer
 
     print(f"  Train: {len(X_train)}, Val: {len(X_val)}")
 
+    # Validation always runs with no hints revealed (common case), so mask once
+    X_val_masked = X_val.clone()
+    X_val_masked[:, 6:26, 4] = -1.0
+
     model = FingeringTransformer(d_model=d_model, nhead=nhead, num_layers=num_layers,
                                   dim_feedforward=dim_feedforward)
     n_params = sum(p.numel() for p in model.parameters())
     print(f"  Model: d_model={d_model}, heads={nhead}, layers={num_layers}, ff={dim_feedforward} ({n_params:,} params)")
 
+    # Inference-only compiled view for validation; shares parameters with model
+    eval_model = torch.compile(model, dynamic=False) if compile else model
+
     train_dataset = TensorDataset(X_train, Y_train)
-    train_loader = DataLoader(train_dataset, batch_size=256, shuffle=True)
+    train_loader = DataLoader(train_dataset, batch_size=256, shuffle=True,
+                              collate_fn=collate_masked,
+                              num_workers=num_workers,
+                              pin_memory=torch.cuda.is_available(),
+                              persistent_workers=num_workers > 0)
 
-    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.01)
+    optimizer = make_optimizer(model, lr)
 
     best_val_acc = 0.0
     best_model_state = None
@@ -136,10 +232,8 @@ def train(hand='right', max_epochs=300, lr=0.001, d_model=64, nhead=4, num_layer
         model.train()
 
         for X_batch, Y_batch in train_loader:
-            optimizer.zero_grad()
-
-            # Randomly mask finger hints for data augmentation
-            X_batch = mask_finger_hints(X_batch)
+            # Finger hints are already randomly masked by collate_masked
+            optimizer.zero_grad(set_to_none=True)
 
             logits = model(X_batch)  # (batch, 5)
             loss = F.cross_entropy(logits, Y_batch, label_smoothing=0.1)
@@ -150,21 +244,16 @@ def train(hand='right', max_epochs=300, lr=0.001, d_model=64, nhead=4, num_layer
         # Validate every 5 epochs (with no hints revealed - common case)
         if epoch % 5 == 0 or epoch == max_epochs - 1:
             model.eval()
-            with torch.no_grad():
-                # Mask all finger hints for validation
-                X_val_masked = X_val.clone()
-                X_val_masked[:, 6:26, 4] = -1.0
-
-                logits = model(X_val_masked)
-                preds = logits.argmax(dim=1)
-                val_acc = (preds == Y_val).float().mean().item()
+            preds = predict_in_batches(eval_model, X_val_masked)
+            val_acc = (preds == Y_val).float().mean().item()
         else:
             val_acc = best_val_acc
 
         # Check for improvement
         if val_acc > best_val_acc + 1e-6:
             best_val_acc = val_acc
-            best_model_state = {k: v.clone() for k, v in model.state_dict().items()}
+            # Snapshot on CPU so it does not hold accelerator memory during training
+            best_model_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
             epochs_without_improvement = 0
             lr_epochs_without_improvement = 0
         else:
@@ -193,21 +282,26 @@ def train(hand='right', max_epochs=300, lr=0.001, d_model=64, nhead=4, num_layer
 
     print(f"\n  Best val_acc: {best_val_acc:.4f}")
 
+    # Optional quantization-aware finetune at lr/10 so INT8 export keeps accuracy
+    if qat_epochs > 0:
+        print(f"\n  Quantization-aware training ({qat_epochs} epochs)...")
+        best_val_acc = finetune_qat(model, train_loader, X_val_masked, Y_val,
+                                    epochs=qat_epochs, lr=lr / 10)
+        print(f"  Best INT8 val_acc: {best_val_acc:.4f}")
+
     # Per-finger accuracy (with no hints revealed)
     model.eval()
-    with torch.no_grad():
-        X_val_masked = X_val.clone()
-        X_val_masked[:, 6:26, 4] = -1.0
+    preds = predict_in_batches(eval_model, X_val_masked)
 
-        logits = model(X_val_masked)
-        preds = logits.argmax(dim=1)
+    # Per-finger totals and hits in one pass, read back with a single .tolist() each
+    totals = torch.bincount(Y_val, minlength=5).tolist()
+    correct = torch.bincount(Y_val[preds == Y_val], minlength=5).tolist()
 
-        print("  Per-finger accuracy:")
-        for finger in range(5):
-            mask = Y_val == finger
-            if mask.sum() > 0:
-                acc = (preds[mask] == Y_val[mask]).float().mean().item()
-                print(f"    Finger {finger+1}: {acc:.4f} ({mask.sum().item()} samples)")
+    print("  Per-finger accuracy:")
+    for finger in range(5):
+        if totals[finger] > 0:
+            acc = correct[finger] / totals[finger]
+            print(f"    Finger {finger+1}: {acc:.4f} ({totals[finger]} samples)")
 
     # Save
     checkpoints_dir = PROJECT_ROOT / "checkpoints"
@@ -244,6 +338,12 @@ if __name__ == "__main__":
                         help='Learning rate (default: 0.001)')
     parser.add_argument('--patience', type=int, default=50,
                         help='Early stopping patience (default: 50)')
+    parser.add_argument('--compile', action='store_true',
+                        help='Run validation through torch.compile')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='DataLoader workers for batching and hint masking (default: 4)')
+    parser.add_argument('--qat_epochs', type=int, default=0,
+                        help='INT8 quantization-aware finetune epochs after training (default: 0)')
 
     args = parser.parse_args()
 
@@ -257,5 +357,8 @@ if __name__ == "__main__":
               nhead=args.nhead,
               num_layers=args.num_layers,
               dim_feedforward=args.dim_feedforward,
-              patience=args.patience)
+              patience=args.patience,
+              compile=args.compile,
+              num_workers=args.num_workers,
+              qat_epochs=args.qat_epochs)
         print()